@@ -1,25 +1,30 @@
-from asyncio import sleep, run
+from asyncio import Event, create_task, gather, get_running_loop, sleep, run, to_thread, wait_for
 from datetime import datetime, date
-from json import load
 from logging import INFO, DEBUG, getLogger, StreamHandler, Logger, Formatter
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+from queue import SimpleQueue
 from os import access, R_OK, makedirs
 from os.path import isfile, exists
-from re import compile, match
+from re import compile
 from sys import argv
 from typing import Optional, Callable
 
 # noinspection PyPackageRequirements
-from azure.identity import InteractiveBrowserCredential, TokenCachePersistenceOptions
+from azure.identity import AuthenticationRecord, InteractiveBrowserCredential, TokenCachePersistenceOptions
 from colorlog import ColoredFormatter
-from msgraph import GraphServiceClient
+from httpx import AsyncClient, Limits
+from kiota_authentication_azure.azure_identity_authentication_provider import AzureIdentityAuthenticationProvider
+from msgraph import GraphRequestAdapter, GraphServiceClient
+from msgraph_core import GraphClientFactory
 from msgraph.generated.communications.get_presences_by_user_id.get_presences_by_user_id_post_request_body import \
     GetPresencesByUserIdPostRequestBody
 from msgraph.generated.models.presence import Presence
 from msgraph.generated.users.users_request_builder import UsersRequestBuilder
-from peewee import Model, CharField, SqliteDatabase, ForeignKeyField, DateTimeField, SQL, fn, DoesNotExist, \
+from peewee import Model, CharField, SqliteDatabase, ForeignKeyField, DateTimeField, SQL, fn, \
     IntegerField, JOIN, PrimaryKeyField
 
+from params import get_params
+
 _APP_NAME = "presence_tracker"
 
 
@@ -53,8 +58,7 @@ class Params:
         if not self._is_valid_file(params_file_path):
             exit(1)
 
-        with open(params_file_path) as params_file:
-            params_dict = load(params_file)
+        params_dict = get_params(params_file_path)
 
         self.authority = params_dict.get("authority", self._DEFAULT_AUTHORITY)
         self.azure_client_id = params_dict.get("azure_client_id", self._DEFAULT_AZURE_CLIENT_ID)
@@ -83,14 +87,20 @@ class Params:
 
     @staticmethod
     def _count_plus_at_start(mail: str) -> int:
-        m = match(r"^(\+*)", mail)
-        if m:
-            return len(m.group())
-        else:
-            return 0
+        return len(mail) - len(mail.lstrip("+"))
 
 
-db = SqliteDatabase(f"{_APP_NAME}.db")
+db = SqliteDatabase(
+    f"{_APP_NAME}.db",
+    pragmas={
+        "journal_mode": "wal",
+        "synchronous": 1,
+        "cache_size": -16000,
+        "temp_store": "memory",
+        "mmap_size": 268435456,
+        "foreign_keys": 1
+    }
+)
 
 
 class DbBase(Model):
@@ -112,6 +122,7 @@ class DbSession(DbBase):
     id = PrimaryKeyField(null=False)
     start_time = DateTimeField(default=datetime.now)
     end_time = DateTimeField(null=True)
+    duration_seconds = IntegerField(null=True)
 
     class Meta:
         db_table = "session"
@@ -126,6 +137,10 @@ class DbPresence(DbBase):
 
     class Meta:
         db_table = "presence"
+        indexes = (
+            (("user", "start_time"), False),
+            (("user", "end_time"), False),
+        )
 
 
 class Repository:
@@ -133,54 +148,57 @@ class Repository:
     def init_db() -> None:
         db.connect()
         db.create_tables([DbUser, DbPresence, DbSession], safe=True)
+        if "duration_seconds" not in [column.name for column in db.get_columns("session")]:
+            db.execute_sql("ALTER TABLE session ADD COLUMN duration_seconds INTEGER")
+        db.execute_sql("CREATE INDEX IF NOT EXISTS idx_presence_session ON presence(session_id, start_time)")
+        db.execute_sql("CREATE INDEX IF NOT EXISTS idx_presence_start ON presence(start_time)")
+        db.execute_sql("CREATE INDEX IF NOT EXISTS idx_session_start ON session(start_time)")
 
     @staticmethod
     def start_session() -> DbSession:
         return DbSession.create()
 
     @staticmethod
-    def add_user(user_id: str, mail: str, display_name: str, job_title: str) -> None:
-        user, created = DbUser.get_or_create(
-            id=user_id,
-            defaults={
-                "mail": mail.lower(),
-                "display_name": display_name,
-                "job_title": job_title
-            }
-        )
-        if not created and (user.display_name != display_name or user.job_title != job_title):
-            user.display_name = display_name
-            user.job_title = job_title
-            user.save()
+    def add_users(rows: list[tuple]) -> None:
+        with db.atomic():
+            DbUser.insert_many(
+                rows, fields=[DbUser.id, DbUser.mail, DbUser.display_name, DbUser.job_title]
+            ).on_conflict_ignore().execute()
 
     @staticmethod
-    def get_user(user_id: str):
-        return DbUser.get(DbUser.id == user_id)
-
-    @staticmethod
-    def get_last_presence(user_id: str):
-        try:
-            return DbPresence.select().where(DbPresence.user == user_id).order_by(DbPresence.start_time.desc()).get()
-        except DoesNotExist:
-            return None
+    def get_last_presences(user_ids: list[str]) -> dict:
+        latest = (
+            DbPresence
+            .select(DbPresence.user.alias("latest_user_id"), fn.MAX(DbPresence.start_time).alias("latest_start"))
+            .where(DbPresence.user.in_(user_ids))
+            .group_by(DbPresence.user)
+            .alias("latest")
+        )
+        query = DbPresence.select().join(
+            latest,
+            on=((DbPresence.user == latest.c.latest_user_id) & (DbPresence.start_time == latest.c.latest_start))
+        )
+        return {presence.user_id: presence for presence in query}
 
     @staticmethod
-    def update_presence_end_time_and_duration(user_id: str, end_time: datetime, duration_seconds: int):
-        query = DbPresence.update(end_time=end_time, duration_seconds=duration_seconds).where(
-            (DbPresence.user == user_id) & (DbPresence.end_time.is_null())
-        )
-        query.execute()
+    def add_presences(session: DbSession, opened: list[tuple[str, datetime]]) -> None:
+        DbPresence.insert_many(
+            [(session.id, user_id, start_time, None, 0) for user_id, start_time in opened],
+            fields=[
+                DbPresence.session, DbPresence.user, DbPresence.start_time,
+                DbPresence.end_time, DbPresence.duration_seconds
+            ]
+        ).execute()
 
     @staticmethod
-    def add_presence(session: DbSession, user_id, start_time, end_time, duration_seconds: int) -> None:
-        user = Repository.get_user(user_id)
-        DbPresence.create(
-            session=session,
-            user=user,
-            start_time=start_time,
+    def close_presences(user_ids: list[str], end_time: datetime) -> None:
+        DbPresence.update(
             end_time=end_time,
-            duration_seconds=duration_seconds
-        )
+            duration_seconds=fn.Round((fn.JulianDay(end_time) - fn.JulianDay(DbPresence.start_time)) * 86400)
+        ).where(
+            (DbPresence.user.in_(user_ids)) &
+            (DbPresence.end_time.is_null())
+        ).execute()
 
     @staticmethod
     def get_users_by_emails(emails: list[str]):
@@ -199,7 +217,8 @@ class Repository:
             (~(DbPresence.start_time.is_null())) &
             (DbPresence.end_time.is_null())
         )
-        return query.execute()
+        with db.atomic():
+            return query.execute()
 
     @staticmethod
     def get_user_availability(user_mails: list[str], start_dt: datetime, end_dt: datetime):
@@ -216,21 +235,26 @@ class Repository:
             .order_by(SQL("total_seconds").desc())
         )
 
-        return result
+        return result.dicts()
 
 
 class PresenceTracker:
     def __init__(self):
         self.params = Params()
-        self.logger = self.configure_logger()
-        self._log_severities = {
-            0: self.logger.info,
-            1: self.logger.warning,
-            2: self.logger.error,
-            3: self.logger.critical
+        self.logger, self._log_listener = self.configure_logger()
+        self._log_by_severity = (self.logger.info, self.logger.warning, self.logger.error, self.logger.critical)
+        max_severity_index = len(self._log_by_severity) - 1
+        self._log_func_by_email = {
+            email: self._log_by_severity[min(severity, max_severity_index)]
+            for email, severity in self.params.tracked_user_email_severity.items()
         }
+        self._http_client: Optional[AsyncClient] = None
         self.graph_client = self._initialize_graph_client(self.params)
         self.session = None
+        self._users_by_id: dict[str, DbUser] = {}
+        self._tracked_user_ids: list[str] = []
+        self._open_presence_since: dict[str, datetime] = {}
+        self._stop_event = Event()
         Repository.init_db()
 
     async def __aenter__(self):
@@ -246,8 +270,9 @@ class PresenceTracker:
         if datetime.now() < start_dt:
             self.logger.info(f"Waiting until the scheduled start time: {self._format_time(start_dt)}...")
 
-            while datetime.now() < start_dt:
-                await sleep(1)
+            delay_seconds = (start_dt - datetime.now()).total_seconds()
+            if delay_seconds > 0:
+                await sleep(delay_seconds)
 
         self.session = Repository.start_session()
         self.logger.info(f"Presence tracker started, session id: {self.session.id}")
@@ -257,46 +282,99 @@ class PresenceTracker:
         self._print_presence_statistics(start_dt, end_dt)
 
     async def _populate_tracked_users_async(self) -> None:
-        email_chunks = self._chunk_emails(self.params.tracked_user_emails)
-        for chunk in email_chunks:
-            db_users = {user.mail: user for user in Repository.get_users_by_emails(chunk)}
-            remaining_emails = [email for email in chunk if email not in db_users]
-
-            if not remaining_emails:
-                continue
-
-            query_params = UsersRequestBuilder.UsersRequestBuilderGetQueryParameters(
-                select=["id", "mail", "displayName", "jobTitle"],
-                filter=f"mail in ({", ".join([f"\"{email}\"" for email in remaining_emails])})",
-            )
-
-            request_config = UsersRequestBuilder.UsersRequestBuilderGetRequestConfiguration(
-                query_parameters=query_params
-            )
-            response = await self.graph_client.users.get(request_configuration=request_config)
+        known_emails = {user.mail for user in Repository.get_users_by_emails(self.params.tracked_user_emails)}
+        remaining_emails = [email for email in self.params.tracked_user_emails if email not in known_emails]
+
+        if remaining_emails:
+            email_chunks = self._chunk_emails(remaining_emails)
+            responses = await gather(*(self._get_users_by_mail_async(chunk) for chunk in email_chunks))
+
+            new_user_rows = [
+                (user.id, user.mail.lower(), user.display_name, user.job_title)
+                for response in responses
+                for user in response.value
+                if user.mail not in known_emails
+            ]
+            if new_user_rows:
+                Repository.add_users(new_user_rows)
+
+        self._users_by_id = {
+            user.id: user for user in Repository.get_users_by_emails(self.params.tracked_user_emails)
+        }
+        self._tracked_user_ids = list(self._users_by_id)
+        self._open_presence_since = {
+            user_id: presence.start_time
+            for user_id, presence in Repository.get_last_presences(self._tracked_user_ids).items()
+            if presence.start_time is not None and presence.end_time is None
+        }
 
-            for user in response.value:
-                if user.mail in db_users:
-                    continue
+    async def _get_users_by_mail_async(self, emails: list[str]):
+        query_params = UsersRequestBuilder.UsersRequestBuilderGetQueryParameters(
+            select=["id", "mail", "displayName", "jobTitle"],
+            filter="mail in (" + ", ".join(f'"{email}"' for email in emails) + ")",
+            count=True,
+        )
 
-                Repository.add_user(user.id, user.mail, user.display_name, user.job_title)
+        request_config = UsersRequestBuilder.UsersRequestBuilderGetRequestConfiguration(
+            query_parameters=query_params
+        )
+        # Advanced query support is required for large "mail in (...)" filters
+        request_config.headers.add("ConsistencyLevel", "eventual")
+        return await self.graph_client.users.get(request_configuration=request_config)
 
     async def _track_until_scheduled_end_time_async(self, end_dt: datetime) -> None:
+        loop = get_running_loop()
+        deadline = loop.time() + (end_dt - datetime.now()).total_seconds()
+        next_tick = loop.time()
         dt_initial = datetime.now()
-        while datetime.now() < end_dt:
-            await self._track_user_presence_async(dt_initial)
+        apply_task = None
+        while loop.time() < deadline:
+            next_tick += self.params.ping_seconds
+
+            # Overlap this tick's presence GET with the previous tick's DB commit
+            fetch_task = create_task(self._get_presences_async())
+            if apply_task is not None:
+                await apply_task
+
+            response = await fetch_task
+            is_initial = dt_initial is not None
+            dt_now = dt_initial if is_initial else datetime.now()
             dt_initial = None
+            apply_task = create_task(to_thread(self._apply_presence_batch, response.value, dt_now, is_initial))
+
+            remaining_seconds = deadline - loop.time()
+            if remaining_seconds <= 0:
+                break
+
+            # Sleep until the next tick, but wake immediately if shutdown is requested
+            try:
+                await wait_for(self._stop_event.wait(), max(0.0, min(next_tick - loop.time(), remaining_seconds)))
+            except TimeoutError:
+                pass
+            else:
+                break
+
+        if apply_task is not None:
+            await apply_task
+
+    async def _get_presences_async(self):
+        request_body = GetPresencesByUserIdPostRequestBody(ids=self._tracked_user_ids)
+        return await self.graph_client.communications.get_presences_by_user_id.post(request_body)
+
+    def _apply_presence_batch(self, presences: list[Presence], dt_now: datetime, is_initial: bool) -> None:
+        opened: list[tuple[str, datetime]] = []
+        closing_user_ids: list[str] = []
+        for presence in presences:
+            self._track_individual_user(
+                presence, dt_now, is_initial, self._users_by_id[presence.id], opened, closing_user_ids
+            )
 
-            await sleep(self.params.ping_seconds)
-
-    async def _track_user_presence_async(self, dt_initial: Optional[datetime]) -> None:
-        db_users = Repository.get_users_by_emails(self.params.tracked_user_emails)
-
-        request_body = GetPresencesByUserIdPostRequestBody(ids=[user.id for user in db_users])
-        response = await self.graph_client.communications.get_presences_by_user_id.post(request_body)
-
-        for presence in response.value:
-            self._track_individual_user(presence, dt_initial)
+        if opened or closing_user_ids:
+            with db.atomic():
+                if opened:
+                    Repository.add_presences(self.session, opened)
+                if closing_user_ids:
+                    Repository.close_presences(closing_user_ids, dt_now)
 
     # noinspection PyMethodMayBeStatic
     def _get_start_and_end_time(self) -> tuple[datetime, datetime]:
@@ -312,14 +390,9 @@ class PresenceTracker:
         end_dt = datetime.combine(date.today(), end_time)
         return start_dt, end_dt
 
+    # noinspection PyMethodMayBeStatic
     def _end_of_scheduled_time_cleanup(self, end_dt: datetime) -> None:
-        for user in Repository.get_users_by_emails(self.params.tracked_user_emails):
-            if user.presences:
-                last_presence = Repository.get_last_presence(user.id)
-
-                if not last_presence.end_time:
-                    duration_seconds = int((end_dt - last_presence.start_time).total_seconds())
-                    Repository.update_presence_end_time_and_duration(user.id, end_dt, duration_seconds)
+        Repository.close_out_incomplete_presence_records(end_dt)
 
     def _print_presence_statistics(self, start_dt: datetime, end_dt: datetime) -> None:
         user_availability = Repository.get_user_availability(self.params.tracked_user_emails, start_dt, end_dt)
@@ -330,46 +403,43 @@ class PresenceTracker:
         else:
             for user in user_availability:
                 self.logger.info(
-                    f"{user.display_name} total unavailability was {round(user.total_seconds / 60, 2)} minute(s)"
+                    f"{user['display_name']} total unavailability was {round(user['total_seconds'] / 60, 2)} minute(s)"
                 )
 
-    def _track_individual_user(self, presence: Presence, dt_initial: Optional[datetime]) -> None:
-        db_user = Repository.get_user(presence.id)
+    def _track_individual_user(
+            self, presence: Presence, dt_now: datetime, is_initial: bool, db_user: DbUser,
+            opened: list[tuple[str, datetime]], closing_user_ids: list[str]
+    ) -> None:
         display_name, email = db_user.display_name, db_user.mail
-        severity = self.params.tracked_user_email_severity[email]
 
-        log_func = self._log_severities.get(min(severity, max(self._log_severities.keys())))
+        log_func = self._log_func_by_email[email]
         availability, user_id = presence.availability, presence.id
-        dt_now = dt_initial if dt_initial is not None else datetime.now()
 
         if availability in ["Away", "Offline"]:
-            last_presence = Repository.get_last_presence(user_id)
-            if last_presence is None or last_presence.end_time is not None:
-                Repository.add_presence(self.session, user_id, dt_now, None, 0)
-                if not dt_initial:
+            if user_id not in self._open_presence_since:
+                self._open_presence_since[user_id] = dt_now
+                opened.append((user_id, dt_now))
+                if not is_initial:
                     log_func(f"{display_name} went {availability.lower()} at {self._format_time(dt_now)}")
         else:
-            self._handle_user_becoming_available(user_id, dt_now, log_func)
-
-    def _handle_user_becoming_available(self, user_id: str, dt_available: datetime, log: Callable) -> None:
-        last_presence = Repository.get_last_presence(user_id)
-
-        if last_presence is not None and last_presence.start_time is not None and last_presence.end_time is None:
-            self._end_unavailability_presence(user_id, last_presence.start_time, dt_available, log)
-
-    def _end_unavailability_presence(self, user_id: str, dt_start: datetime, dt_end: datetime, log: Callable) -> None:
-        str_start, str_end = self._format_time(dt_start), self._format_time(dt_end)
-
-        if str_start != str_end:
-            log(f"{Repository.get_user(user_id).display_name} was unavailable from {str_start} to {str_end}")
-
-        duration_seconds = int((dt_end - dt_start).total_seconds())
-        Repository.update_presence_end_time_and_duration(user_id, dt_end, duration_seconds)
+            dt_open_start = self._open_presence_since.pop(user_id, None)
+            if dt_open_start is not None:
+                closing_user_ids.append(user_id)
+                self._log_ended_unavailability(db_user, dt_open_start, dt_now, log_func)
+
+    def _log_ended_unavailability(self, db_user: DbUser, dt_start: datetime, dt_end: datetime, log: Callable) -> None:
+        if dt_start != dt_end:
+            log(
+                f"{db_user.display_name} was unavailable "
+                f"from {self._format_time(dt_start)} to {self._format_time(dt_end)}"
+            )
 
     async def cleanup_async(self):
+        self._stop_event.set()
         now = datetime.now()
         if self.session is not None:
             self.session.end_time = now
+            self.session.duration_seconds = int((now - self.session.start_time).total_seconds())
             self.session.save()
 
         deleted_records = Repository.delete_invalid_presence_records()
@@ -383,8 +453,16 @@ class PresenceTracker:
                 f"Cleanup: updated end time to now for {updated_records} presence record(s) with missing end time"
             )
 
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+
+        if self._log_listener is not None:
+            self._log_listener.stop()
+            self._log_listener = None
+
     @staticmethod
-    def configure_logger() -> Logger:
+    def configure_logger() -> tuple[Logger, QueueListener]:
         log_dir = "logs"
         if not exists(log_dir):
             makedirs(log_dir)
@@ -398,6 +476,7 @@ class PresenceTracker:
 
         console_handler = StreamHandler()
         console_handler.setLevel(INFO)
+        console_handler.addFilter(lambda record: not record.name.startswith("httpx"))
 
         file_formatter = Formatter(
             "%(levelname)-8s[%(asctime)s] %(message)s",
@@ -417,42 +496,66 @@ class PresenceTracker:
         file_handler.setFormatter(file_formatter)
         console_handler.setFormatter(console_formatter)
 
+        # Log records only pay for a queue put on the hot path; the listener thread does the blocking IO
+        log_queue = SimpleQueue()
+        queue_handler = QueueHandler(log_queue)
+        log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+        log_listener.start()
+
         httpx_logger = getLogger("httpx")
         httpx_logger.setLevel(INFO)
-        httpx_logger.addHandler(file_handler)
+        httpx_logger.addHandler(queue_handler)
 
-        logger.addHandler(file_handler)
-        logger.addHandler(console_handler)
+        logger.addHandler(queue_handler)
 
-        return logger
+        return logger, log_listener
 
-    @staticmethod
-    def _initialize_graph_client(params: Params) -> GraphServiceClient:
+    def _initialize_graph_client(self, params: Params) -> GraphServiceClient:
         read_presence_scope = "Presence.Read"
+        auth_record_path = f"{_APP_NAME}_auth_record.json"
+
+        auth_record = None
+        if isfile(auth_record_path):
+            with open(auth_record_path) as auth_record_file:
+                auth_record = AuthenticationRecord.deserialize(auth_record_file.read())
+
         credentials = InteractiveBrowserCredential(
             client_id=params.azure_client_id,
             authority=params.authority,
             login_hint=params.login_username,
-            cache_persistence_options=TokenCachePersistenceOptions()
+            cache_persistence_options=TokenCachePersistenceOptions(),
+            authentication_record=auth_record
         )
-        credentials.get_token(read_presence_scope)
+
+        if auth_record is None:
+            auth_record = credentials.authenticate(scopes=[read_presence_scope])
+            with open(auth_record_path, "w") as auth_record_file:
+                auth_record_file.write(auth_record.serialize())
+        else:
+            credentials.get_token(read_presence_scope)
 
         # noinspection PyTypeChecker
-        return GraphServiceClient(
-            credentials=credentials,
-            scopes=[read_presence_scope]
+        auth_provider = AzureIdentityAuthenticationProvider(credentials, scopes=[read_presence_scope])
+        self._http_client = GraphClientFactory.create_with_default_middleware(
+            client=AsyncClient(
+                limits=Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=60),
+                timeout=30
+            )
         )
+        return GraphServiceClient(request_adapter=GraphRequestAdapter(auth_provider, self._http_client))
 
     @staticmethod
     def _chunk_emails(emails: list[str]) -> list[list[str]]:
-        email_chunk_limit = 15
+        email_chunk_limit = 100
         chunks = [emails[i:i + email_chunk_limit] for i in range(0, len(emails), email_chunk_limit)]
         return chunks
 
     @staticmethod
     def _format_time(dt: datetime) -> str:
-        # return dt.strftime("%I:%M:%p").lstrip("0").lower()  # real
-        return dt.strftime("%I:%M:%S%p").lstrip("0").lower()  # test
+        hour = dt.hour % 12 or 12
+        meridiem = "am" if dt.hour < 12 else "pm"
+        # return f"{hour}:{dt.minute:02d}{meridiem}"  # real
+        return f"{hour}:{dt.minute:02d}:{dt.second:02d}{meridiem}"  # test
 
 
 async def main():
@@ -0,0 +1,14 @@
+from functools import lru_cache
+
+# Prefer orjson's C decoder when it is installed, otherwise fall back to the stdlib
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+
+# Load and cache the parameters file so repeat callers share one parse
+@lru_cache
+def get_params(params_file_path: str = "params.json") -> dict:
+    with open(params_file_path, "rb") as params_file:
+        return loads(params_file.read())